@@ -0,0 +1,275 @@
+from binaryninja import LowLevelILOperation
+
+from . import decode
+
+# Binary operations lowered straight to a Python expression. Operands are
+# substituted positionally; mask and sign are derived from the size.
+BINARY_OPERATIONS = {
+    LowLevelILOperation.LLIL_ADD: '(({} + {}) & {mask})',
+    LowLevelILOperation.LLIL_SUB: '({} - {})',
+    LowLevelILOperation.LLIL_AND: '({} & {})',
+    LowLevelILOperation.LLIL_OR: '({} | {})',
+    LowLevelILOperation.LLIL_XOR: '({} ^ {})',
+    LowLevelILOperation.LLIL_LSL: '(({} << {}) & {mask})',
+    LowLevelILOperation.LLIL_LSR: '({} >> {})',
+    LowLevelILOperation.LLIL_CMP_E: '({} == {})',
+    LowLevelILOperation.LLIL_CMP_NE: '({} != {})',
+    LowLevelILOperation.LLIL_CMP_UGT: '({} > {})',
+    LowLevelILOperation.LLIL_CMP_SLT:
+        '((({} ^ {sign}) - {sign}) < (({} ^ {sign}) - {sign}))',
+}
+
+
+# Lowers one decoded basic block to a Python function that runs the whole
+# block against an Emilator's state, handing anything it can't lower back
+# to the interpreter. The function returns False without doing anything if
+# a register it reads inline is undefined on entry, so the interpreter can
+# run the block instead and raise at the right instruction.
+#
+# Inline code mirrors native's visitors and register and flag access. Any
+# of those the emilator's class overrides goes through the interpreter, so
+# compiled blocks compute what the interpreter would.
+class BlockCompiler(object):
+    def __init__(self, emilator, native):
+        self._emilator = emilator
+        self._native = native
+        self._inline_reg_reads = self._inherits('get_register_value')
+        self._inline_reg_writes = self._inherits('set_register_value')
+        self._inline_flag_reads = self._inherits('get_flag_value')
+        self._inline_flag_writes = self._inherits('set_flag_value')
+        self._namespace = {
+            '_emi': emilator,
+            '_v': emilator._reg_values,
+            '_tmp': emilator._tmp_regs,
+            '_flags': emilator._flags,
+            '_eval': emilator._eval,
+            '_set_reg': emilator.set_register_value,
+            '_set_flag': emilator.set_flag_value,
+            '_read': emilator._read_fast,
+            '_write': emilator.write_memory,
+        }
+        self._lines = []
+        self._guard_regs = set()
+        self._guard_tmps = set()
+        self._calls = False
+
+    def compile(self, start, instructions):
+        end = start + len(instructions)
+        returns = False
+
+        for index, instruction in enumerate(instructions, start + 1):
+            returns = self._statement(index, instruction)
+
+        if not returns:
+            self._emit('_emi.instr_index = {}'.format(end))
+            self._emit('return True')
+
+        guard = ' or '.join(
+            ['_v[{}] is None'.format(i) for i in sorted(self._guard_regs)] +
+            ['_tmp.get({}) is None'.format(i)
+             for i in sorted(self._guard_tmps)]
+        )
+
+        # Bind everything the block uses as default arguments, so inside the
+        # function they are fast locals rather than global lookups.
+        source = ['def _block({}):'.format(', '.join(
+            '{0}={0}'.format(name) for name in sorted(self._namespace)
+            if name.startswith('_')
+        ))]
+        if guard:
+            source += ['    if ' + guard + ':', '        return False']
+        source += ['    ' + line for line in self._lines]
+
+        code = compile(
+            '\n'.join(source) + '\n', '<emilator block {}>'.format(start),
+            'exec'
+        )
+        exec(code, self._namespace)
+
+        return self._namespace['_block']
+
+    def _inherits(self, name):
+        return (getattr(type(self._emilator), name) is
+                getattr(self._native, name))
+
+    def _is_native(self, expr):
+        return expr.handler is self._native._DISPATCH.resolve(
+            expr.operation, expr.size_key
+        )
+
+    def _emit(self, line):
+        self._lines.append(line)
+
+    def _constant(self, value):
+        name = '_k{}'.format(len(self._namespace))
+        self._namespace[name] = value
+        return name
+
+    def _statement(self, index, instruction):
+        # Returns True if the emitted code leaves the block itself
+        operation = instruction.operation
+        self._calls = False
+
+        if not self._is_native(instruction):
+            return self._fallback(index, instruction)
+
+        if operation == LowLevelILOperation.LLIL_SET_REG:
+            src = self._expr(instruction.src)
+            dest = instruction.dest
+            desc = self._emilator._reg_desc.get(dest)
+
+            if desc is None and not isinstance(dest, int):
+                return self._fallback(index, instruction)
+
+            if self._inline_reg_writes and desc is None:
+                line = '_tmp[{}] = {}'.format(dest, src)
+
+            elif (self._inline_reg_writes and
+                    desc.reg_id == desc.full_width_id):
+                self._sync_index(index)
+                self._emit('_x = {}'.format(src))
+                self._emit(
+                    '_v[{}] = _x if _x >= 0 else _x + {}'.format(
+                        desc.reg_id, desc.mask + 1
+                    )
+                )
+                return False
+
+            else:
+                self._calls = True
+                line = '_set_reg({!r}, {})'.format(dest, src)
+
+        elif operation == LowLevelILOperation.LLIL_SET_FLAG:
+            flag = instruction.dest.index
+            src = self._expr(instruction.src)
+
+            if self._inline_flag_writes:
+                line = '_flags[{}] = {}'.format(flag, src)
+            else:
+                self._calls = True
+                line = '_set_flag({}, {})'.format(flag, src)
+
+        elif operation == LowLevelILOperation.LLIL_STORE:
+            self._calls = True
+            line = '_write({}, {}, {})'.format(
+                self._expr(instruction.dest), self._expr(instruction.src),
+                instruction.size
+            )
+
+        elif operation == LowLevelILOperation.LLIL_GOTO:
+            self._emit('_emi.instr_index = {}'.format(instruction.dest))
+            self._emit('return True')
+            return True
+
+        elif operation == LowLevelILOperation.LLIL_IF:
+            condition = self._expr(instruction.condition)
+            self._sync_index(index)
+            self._emit('_emi.instr_index = {} if {} else {}'.format(
+                instruction.true, condition, instruction.false
+            ))
+            self._emit('return True')
+            return True
+
+        else:
+            return self._fallback(index, instruction)
+
+        self._sync_index(index)
+        self._emit(line)
+        return False
+
+    def _sync_index(self, index):
+        # Keep instr_index accurate for anything that may raise or look at it
+        if self._calls:
+            self._emit('_emi.instr_index = {}'.format(index))
+
+    def _fallback(self, index, instruction):
+        self._emit('_emi.instr_index = {}'.format(index))
+        self._emit('{}(_emi, {})'.format(
+            self._constant(instruction.handler),
+            self._constant(instruction)
+        ))
+
+        if instruction.operation in decode.STRAIGHT_LINE_OPERATIONS:
+            return False
+
+        self._emit('return True')
+        return True
+
+    def _expr(self, expr):
+        operation = expr.operation
+
+        if (operation == LowLevelILOperation.LLIL_CONST or
+                operation == LowLevelILOperation.LLIL_CONST_PTR):
+            return repr(expr.constant)
+
+        if operation == LowLevelILOperation.LLIL_REG:
+            # Like the interpreter, read registers without going through
+            # the visitor
+            lowered = self._register(expr.src)
+        elif self._is_native(expr):
+            lowered = self._operation(expr)
+        else:
+            lowered = None
+
+        if lowered is not None:
+            return lowered
+
+        # Python evaluates operands left to right, so calling back into the
+        # interpreter inline keeps side effects in program order.
+        self._calls = True
+        return '_eval({})'.format(self._constant(expr))
+
+    def _register(self, src):
+        if not self._inline_reg_reads:
+            return None
+
+        if isinstance(src, int):
+            self._guard_tmps.add(src)
+            return '_tmp[{}]'.format(src)
+
+        desc = self._emilator._reg_desc.get(src)
+
+        if desc is None:
+            return None
+
+        self._guard_regs.add(desc.full_width_id)
+
+        if desc.reg_id == desc.full_width_id:
+            return '(_v[{}] & {})'.format(desc.reg_id, desc.mask)
+
+        return '((_v[{}] & {}) >> {})'.format(
+            desc.full_width_id, desc.reg_bits, desc.shift
+        )
+
+    def _operation(self, expr):
+        operation = expr.operation
+
+        if operation in BINARY_OPERATIONS and expr.size:
+            return BINARY_OPERATIONS[operation].format(
+                self._expr(expr.left), self._expr(expr.right),
+                mask=(1 << expr.size * 8) - 1,
+                sign=1 << (expr.size * 8 - 1)
+            )
+
+        if operation == LowLevelILOperation.LLIL_ZX:
+            return self._expr(expr.src)
+
+        if operation == LowLevelILOperation.LLIL_SX and expr.src.size:
+            sign = 1 << (expr.src.size * 8 - 1)
+            return '(((({} & {}) ^ {sign}) - {sign}) & {})'.format(
+                self._expr(expr.src), (sign << 1) - 1,
+                (1 << expr.size * 8) - 1, sign=sign
+            )
+
+        if (operation == LowLevelILOperation.LLIL_FLAG and
+                self._inline_flag_reads):
+            return '_flags.get({}, False)'.format(expr.src.index)
+
+        if operation == LowLevelILOperation.LLIL_LOAD:
+            self._calls = True
+            return '_read({}, {})'.format(self._expr(expr.src), expr.size)
+
+        return None
+
+def compile_block(emilator, start, instructions, native):
+    return BlockCompiler(emilator, native).compile(start, instructions)
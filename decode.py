@@ -0,0 +1,188 @@
+from binaryninja import (LLIL_REG_IS_TEMP, ILRegister, LowLevelILInstruction,
+                         LowLevelILOperation)
+
+# Operations that always fall through to the next instruction. Anything
+# else may transfer control and so ends a basic block.
+STRAIGHT_LINE_OPERATIONS = frozenset([
+    LowLevelILOperation.LLIL_NOP,
+    LowLevelILOperation.LLIL_SET_REG,
+    LowLevelILOperation.LLIL_SET_REG_SPLIT,
+    LowLevelILOperation.LLIL_SET_FLAG,
+    LowLevelILOperation.LLIL_STORE,
+    LowLevelILOperation.LLIL_PUSH,
+])
+
+# Operations whose handlers are specialized on their source operand's size
+# as well as their own
+SOURCE_SIZED_OPERATIONS = frozenset([
+    LowLevelILOperation.LLIL_SX,
+])
+
+CONSTANT_OPERATIONS = frozenset([
+    LowLevelILOperation.LLIL_CONST,
+    LowLevelILOperation.LLIL_CONST_PTR,
+])
+
+# Operations whose value depends only on their operands
+PURE_OPERATIONS = frozenset([
+    LowLevelILOperation.LLIL_ADD,
+    LowLevelILOperation.LLIL_SUB,
+    LowLevelILOperation.LLIL_AND,
+    LowLevelILOperation.LLIL_OR,
+    LowLevelILOperation.LLIL_XOR,
+    LowLevelILOperation.LLIL_LSL,
+    LowLevelILOperation.LLIL_LSR,
+    LowLevelILOperation.LLIL_CMP_E,
+    LowLevelILOperation.LLIL_CMP_NE,
+    LowLevelILOperation.LLIL_CMP_SLT,
+    LowLevelILOperation.LLIL_CMP_UGT,
+    LowLevelILOperation.LLIL_SX,
+    LowLevelILOperation.LLIL_ZX,
+])
+
+
+def decode_operand(operand, dispatch):
+    if isinstance(operand, LowLevelILInstruction):
+        return DecodedExpression(operand, dispatch)
+
+    if isinstance(operand, ILRegister):
+        # set/get_register_value take a temp register index or a name
+        if LLIL_REG_IS_TEMP(operand.index):
+            return operand.index
+        return operand.name
+
+    if isinstance(operand, list):
+        return [decode_operand(o, dispatch) for o in operand]
+
+    return operand
+
+
+# A LowLevelILInstruction with its operands read out once. Operands are
+# plain attributes named as on the original expression, so visitors can
+# take either one. handler is the visitor resolved from the dispatch table
+# for this operation and size_key: the size, or (size, source size) for
+# SOURCE_SIZED_OPERATIONS.
+class DecodedExpression(object):
+    def __init__(self, expr, dispatch):
+        self.expr = expr
+        self.operation = expr.operation
+        self.size = expr.size
+
+        if self.operation in SOURCE_SIZED_OPERATIONS:
+            self.size_key = (expr.size, expr.src.size)
+        else:
+            self.size_key = expr.size
+
+        self.handler = dispatch.resolve(self.operation, self.size_key)
+
+        operands = LowLevelILInstruction.ILOperations.get(self.operation, [])
+
+        for name, _ in operands:
+            setattr(self, name, decode_operand(getattr(expr, name), dispatch))
+
+    def __repr__(self):
+        return '<DecodedExpression: {!r}>'.format(self.expr)
+
+
+def fold_constants(expr, evaluate, dispatch, native):
+    # Evaluate pure sub-expressions of constants once, turning them into
+    # LLIL_CONST in place so every later evaluation is a plain read. Only
+    # handlers from the native table are run this early; anything else,
+    # such as a subclass override, runs each time it is executed.
+    operands = [
+        operand for operand in vars(expr).values()
+        if isinstance(operand, DecodedExpression)
+    ]
+
+    for operand in operands:
+        fold_constants(operand, evaluate, dispatch, native)
+
+    if expr.operation not in PURE_OPERATIONS:
+        return
+
+    if expr.handler is not native.resolve(expr.operation, expr.size_key):
+        return
+
+    if not all(o.operation in CONSTANT_OPERATIONS for o in operands):
+        return
+
+    try:
+        constant = evaluate(expr)
+    except Exception:
+        # Leave it to fail, if it ever runs, when it is executed
+        return
+
+    expr.operation = LowLevelILOperation.LLIL_CONST
+    expr.constant = constant
+    expr.size_key = expr.size
+    expr.handler = dispatch.resolve(expr.operation, expr.size_key)
+
+
+class DecodedFunction(object):
+    def __init__(self, function, dispatch, evaluate=None, native=None):
+        self.function = function
+        self.dispatch = dispatch
+        self.evaluate = evaluate
+
+        # Dispatch table whose handlers are safe to run while decoding
+        self.native = dispatch if native is None else native
+        self.instructions = []
+
+        # start index -> the instructions of the basic block starting there
+        self.blocks = {}
+
+        # start index -> times the block was entered / its compiled form
+        self.block_hits = {}
+        self.compiled_blocks = {}
+
+        self.update()
+
+    def update(self):
+        # Only decode what is missing; the function may have been appended
+        # to since it was last decoded.
+        function = self.function
+        instructions = self.instructions
+
+        if len(instructions) == len(function):
+            return
+
+        new_instructions = [
+            DecodedExpression(function[i], self.dispatch)
+            for i in range(len(instructions), len(function))
+        ]
+
+        if self.evaluate is not None:
+            for instruction in new_instructions:
+                fold_constants(
+                    instruction, self.evaluate, self.dispatch, self.native
+                )
+
+        instructions.extend(new_instructions)
+
+        self._split_blocks()
+
+    def _split_blocks(self):
+        instructions = self.instructions
+        leaders = set([0])
+
+        for index, instruction in enumerate(instructions):
+            if instruction.operation in STRAIGHT_LINE_OPERATIONS:
+                continue
+
+            leaders.add(index + 1)
+
+            if instruction.operation == LowLevelILOperation.LLIL_GOTO:
+                leaders.add(instruction.dest)
+            elif instruction.operation == LowLevelILOperation.LLIL_IF:
+                leaders.add(instruction.true)
+                leaders.add(instruction.false)
+
+        starts = sorted(i for i in leaders if 0 <= i < len(instructions))
+
+        self.blocks.clear()
+        self.block_hits.clear()
+        self.compiled_blocks.clear()
+
+        for start, end in zip(starts, starts[1:] + [len(instructions)]):
+            self.blocks[start] = instructions[start:end]
+            self.block_hits[start] = 0
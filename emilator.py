@@ -1,37 +1,177 @@
 import struct
+import types
+from collections import namedtuple
 
+from . import codegen
+from . import decode
 from . import errors
 from . import llilvisitor
 from . import memory
 from binaryninja import (LLIL_GET_TEMP_REG_INDEX, LLIL_REG_IS_TEMP,
                          Architecture, BinaryView, Endianness, ILRegister,
                          ImplicitRegisterExtend, LowLevelILFunction,
-                         SegmentFlag)
+                         LowLevelILOperation, SegmentFlag)
+
+LLIL_CONST = LowLevelILOperation.LLIL_CONST
+LLIL_CONST_PTR = LowLevelILOperation.LLIL_CONST_PTR
+LLIL_REG = LowLevelILOperation.LLIL_REG
 
 fmt = {1: 'B', 2: 'H', 4: 'L', 8: 'Q'}
 
+class Packers(dict):
+    def __missing__(self, length):
+        raise ValueError('read length must be in (1,2,4,8)')
+
+
+little_endian_packers = Packers(
+    (length, struct.Struct('<' + f)) for length, f in fmt.items()
+)
+big_endian_packers = Packers(
+    (length, struct.Struct('>' + f)) for length, f in fmt.items()
+)
+
+
+# Everything set/get_register_value needs to know about a register
+RegisterDescriptor = namedtuple('RegisterDescriptor', [
+    'reg_id', 'full_width_id', 'mask', 'full_mask', 'shift', 'reg_bits',
+    'extend'
+])
+
+
+class SizeTable(dict):
+    # size in bytes -> value, computed on first use for unusual sizes
+    def __init__(self, compute):
+        super(SizeTable, self).__init__(
+            (size, compute(size)) for size in (1, 2, 4, 8)
+        )
+        self._compute = compute
+
+    def __missing__(self, size):
+        value = self[size] = self._compute(size)
+        return value
+
+
+size_masks = SizeTable(lambda size: (1 << size * 8) - 1)
+sign_bits = SizeTable(lambda size: 1 << (size * 8 - 1))
+
 
 def sign_extend(value, bits):
     sign_bit = 1 << (bits - 1)
-    return (value & (sign_bit - 1)) - (value & sign_bit)
+    return ((value & ((sign_bit << 1) - 1)) ^ sign_bit) - sign_bit
+
+
+# Variants of the size dependent visitors with their mask or sign bit
+# fixed, listed in Emilator._SIZE_SPECIALIZATIONS; each factory takes the
+# operand size, or (size, source size) for sign extension.
+def specialize_add(size):
+    mask = size_masks[size]
+
+    def visit(self, expr):
+        return (self._eval(expr.left) + self._eval(expr.right)) & mask
+    return visit
+
+
+def specialize_lsl(size):
+    mask = size_masks[size]
+
+    def visit(self, expr):
+        return (self._eval(expr.left) << self._eval(expr.right)) & mask
+    return visit
+
+
+def specialize_cmp_slt(size):
+    sign_bit = sign_bits[size]
+
+    def visit(self, expr):
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
+        return ((left ^ sign_bit) - sign_bit) < ((right ^ sign_bit) - sign_bit)
+    return visit
+
+
+def specialize_sx(sizes):
+    size, src_size = sizes
+    mask = size_masks[size]
+    src_mask = size_masks[src_size]
+    sign_bit = sign_bits[src_size]
+
+    def visit(self, expr):
+        value = self._eval(expr.src)
+        return (((value & src_mask) ^ sign_bit) - sign_bit) & mask
+    return visit
+
+
+SIZES = (1, 2, 4, 8)
+
+# (size, source size) pairs for extending to a wider size
+EXTEND_SIZES = tuple(
+    (size, src_size) for size in SIZES for src_size in SIZES
+    if src_size < size
+)
 
 
 class Emilator(llilvisitor.LLILVisitor):
+    # Basic blocks entered this many times by run_until_halt are compiled
+    # to Python functions by codegen; 0, the default, disables compilation.
+    # execute_instruction and run always step one instruction at a time.
+    jit_threshold = 0
+
+    # operation -> (factory, sizes to build a handler for). Subclasses
+    # inherit the handlers unless they override the generic visitor.
+    _SIZE_SPECIALIZATIONS = {
+        LowLevelILOperation.LLIL_ADD: (specialize_add, SIZES),
+        LowLevelILOperation.LLIL_LSL: (specialize_lsl, SIZES),
+        LowLevelILOperation.LLIL_CMP_SLT: (specialize_cmp_slt, SIZES),
+        LowLevelILOperation.LLIL_SX: (specialize_sx, EXTEND_SIZES),
+    }
+
     def __init__(self, function, view=None):
         super(Emilator, self).__init__()
 
         if not isinstance(function, LowLevelILFunction):
             raise TypeError('function must be a LowLevelILFunction')
 
-        self._function = function
+        # Decoded IL instructions per function, keyed by id(). Each entry
+        # keeps its function alive so the id cannot be reused.
+        self._instr_cache = {}
+        self._switch_function(function)
 
         if view is None:
             view = BinaryView()
 
         self._view = view
 
-        self._regs = {}
+        # Register values live in a list indexed by a register id assigned
+        # here; only full width registers ever hold a value. None means the
+        # register is undefined. Temp registers are sparse and stay in a dict.
+        self._reg_names = list(function.arch.regs)
+        self._reg_values = [None] * len(self._reg_names)
+        self._tmp_regs = {}
         self._flags = {}
+
+        reg_ids = {name: i for i, name in enumerate(self._reg_names)}
+
+        # register name -> RegisterDescriptor
+        self._reg_desc = {}
+        for name, reg_info in function.arch.regs.items():
+            full_width_reg_info = function.arch.regs[reg_info.full_width_reg]
+            mask = size_masks[reg_info.size]
+            shift = reg_info.offset * 8
+            self._reg_desc[name] = RegisterDescriptor(
+                reg_id=reg_ids[name],
+                full_width_id=reg_ids[reg_info.full_width_reg],
+                mask=mask,
+                full_mask=size_masks[full_width_reg_info.size],
+                shift=shift,
+                reg_bits=mask << shift,
+                extend=reg_info.extend
+            )
+
+        # The stack pointer is always a full width register, so push and
+        # pop can use its slot in _reg_values directly.
+        self._sp_name = function.arch.stack_pointer
+        self._sp_desc = self._reg_desc[self._sp_name]
+
         self._memory = memory.Memory(function.arch.address_size)
 
         for segment in view.segments:
@@ -41,6 +181,10 @@ class Emilator(llilvisitor.LLILVisitor):
             )
 
         self._function_hooks = {}
+
+        # call target address -> LowLevelILFunction
+        self._call_target_cache = {}
+
         self.instr_index = 0
 
     @property
@@ -49,19 +193,28 @@ class Emilator(llilvisitor.LLILVisitor):
 
     @property
     def mapped_memory(self):
-        return list(self._memory)
+        return tuple(self._memory)
 
     @property
     def registers(self):
-        return dict(self._regs)
+        # Register values aren't stored as a mapping, so this is always a
+        # fresh snapshot.
+        registers = {
+            name: value
+            for name, value in zip(self._reg_names, self._reg_values)
+            if value is not None
+        }
+        registers.update(self._tmp_regs)
+        return registers
 
     @property
     def function_hooks(self):
-        return dict(self._function_hooks)
+        # Read-only view; use dict(emi.function_hooks) for a snapshot
+        return types.MappingProxyType(self._function_hooks)
 
     @property
     def instr_hooks(self):
-        return dict(self._hooks)
+        return types.MappingProxyType(self._hooks)
 
     def map_memory(self,
                    start=None,
@@ -92,67 +245,63 @@ class Emilator(llilvisitor.LLILVisitor):
         # Maybe this will be an issue eventually, maybe not.
         if (isinstance(register, int) and 
                 LLIL_REG_IS_TEMP(register)):
-            self._regs[register] = value
+            self._tmp_regs[register] = value
             return value
 
         if isinstance(register, ILRegister):
             if not LLIL_REG_IS_TEMP(register.index):
                 register = register.name
             else:
-                self._regs[register.index] = value
+                self._tmp_regs[register.index] = value
                 return value
 
-        arch = self._function.arch
-
-        reg_info = arch.regs[register]
+        desc = self._reg_desc[register]
+        mask = desc.mask
+        full_width_id = desc.full_width_id
+        extend = desc.extend
+        reg_values = self._reg_values
 
         # normalize value to be unsigned
         if value < 0:
-            value = value + (1 << reg_info.size * 8)
+            value = value + mask + 1
 
-        if register == reg_info.full_width_reg:
-            self._regs[register] = value
+        if desc.reg_id == full_width_id:
+            reg_values[full_width_id] = value
             return value
 
-        full_width_reg_info = arch.regs[reg_info.full_width_reg]
-        full_width_reg_value = self._regs.get(full_width_reg_info.full_width_reg)
+        full_width_reg_value = reg_values[full_width_id]
 
         if (full_width_reg_value is None and
-                (reg_info.extend == ImplicitRegisterExtend.NoExtend or
-                 reg_info.offset != 0)):
+                (extend == ImplicitRegisterExtend.NoExtend or
+                 desc.shift != 0)):
             raise errors.UndefinedError(
                 'Register {} not defined'.format(
-                    reg_info.full_width_reg
+                    self._reg_names[full_width_id]
                 )
             )
 
-        if reg_info.extend == ImplicitRegisterExtend.ZeroExtendToFullWidth:
+        if extend == ImplicitRegisterExtend.ZeroExtendToFullWidth:
             full_width_reg_value = value
 
-        elif reg_info.extend == ImplicitRegisterExtend.SignExtendToFullWidth:
+        elif extend == ImplicitRegisterExtend.SignExtendToFullWidth:
+            sign_bit = (mask >> 1) + 1
             full_width_reg_value = (
-                (value ^ ((1 << reg_info.size * 8) - 1)) -
-                ((1 << reg_info.size * 8) - 1) +
-                (1 << full_width_reg_info.size * 8)
+                (((value & mask) ^ sign_bit) - sign_bit) & desc.full_mask
             )
 
-        elif reg_info.extend == ImplicitRegisterExtend.NoExtend:
+        elif extend == ImplicitRegisterExtend.NoExtend:
             # mask off the value that will be replaced
-            mask = (1 << reg_info.size * 8) - 1
-            full_mask = (1 << full_width_reg_info.size * 8) - 1
-            reg_bits = mask << (reg_info.offset * 8)
-
-            full_width_reg_value &= full_mask ^ reg_bits
-            full_width_reg_value |= value << reg_info.offset * 8
+            full_width_reg_value &= desc.full_mask ^ desc.reg_bits
+            full_width_reg_value |= value << desc.shift
 
-        self._regs[full_width_reg_info.full_width_reg] = full_width_reg_value
+        reg_values[full_width_id] = full_width_reg_value
 
         return full_width_reg_value
 
     def get_register_value(self, register):
         if (isinstance(register, int) and
                 LLIL_REG_IS_TEMP(register)):
-            reg_value = self._regs.get(register)
+            reg_value = self._tmp_regs.get(register)
 
             if reg_value is None:
                 raise errors.UndefinedError(
@@ -167,18 +316,18 @@ class Emilator(llilvisitor.LLILVisitor):
             if not LLIL_REG_IS_TEMP(register.index):
                 register = register.name
             else:
-                reg_value = self._regs.get(register.index)
+                reg_value = self._tmp_regs.get(register.index)
                 if reg_value is None:
                     raise errors.UndefinedError(
                         'Register {} not defined'.format(
-                            LLIL_GET_TEMP_REG_INDEX(register)
+                            LLIL_GET_TEMP_REG_INDEX(register.index)
                         )
                     )
                 return reg_value
 
-        reg_info = self._function.arch.regs[register]
+        desc = self._reg_desc[register]
 
-        full_reg_value = self._regs.get(reg_info.full_width_reg)
+        full_reg_value = self._reg_values[desc.full_width_id]
 
         if full_reg_value is None:
             raise errors.UndefinedError(
@@ -187,17 +336,10 @@ class Emilator(llilvisitor.LLILVisitor):
                 )
             )
 
-        mask = (1 << reg_info.size * 8) - 1
-
-        if register == reg_info.full_width_reg:
-            return full_reg_value & mask
-
-        mask = (1 << reg_info.size * 8) - 1
-        reg_bits = mask << (reg_info.offset * 8)
-
-        reg_value = (full_reg_value & reg_bits) >> (reg_info.offset * 8)
+        if desc.reg_id == desc.full_width_id:
+            return full_reg_value & desc.mask
 
-        return reg_value
+        return (full_reg_value & desc.reg_bits) >> desc.shift
 
     def set_flag_value(self, flag, value):
         self._flags[flag] = value
@@ -209,30 +351,33 @@ class Emilator(llilvisitor.LLILVisitor):
         return value
 
     def read_memory(self, addr, length):
-        if length not in fmt:
+        if length not in self._packers:
             raise ValueError('read length must be in (1,2,4,8)')
 
         # XXX: Handle sizes > 8 bytes
-        pack_fmt = (
-            # XXX: Endianness string bug
-            '<' if self._function.arch.endianness == Endianness.LittleEndian
-            else ''
-        ) + fmt[length]
-
         if addr not in self._memory:
             raise errors.MemoryAccessError(
                 'Address {:x} is not valid.'.format(addr)
             )
 
         try:
-            return struct.unpack(
-                pack_fmt, self._memory.read(addr, length)
-            )[0]
+            data = self._memory.read_bytes(addr, length)
+
+            if length == 1:
+                return data[0]
+
+            return self._packers[length].unpack(data)[0]
         except:
             raise errors.MemoryAccessError(
                 'Could not read memory at {:x}'.format(addr)
             )
 
+    def _read_fast(self, addr, length):
+        # Unchecked read_memory for visitors: length comes from the IL and
+        # a bad address surfaces as the MemoryAccessError from lookup.
+        data, offset = self._memory.lookup(addr, length)
+        return self._packers[length].unpack_from(data, offset)[0]
+
     def write_memory(self, addr, data, length=None):
         # XXX: This is terribly implemented
         if addr not in self._memory:
@@ -245,60 +390,158 @@ class Emilator(llilvisitor.LLILVisitor):
                 raise KeyError('length is not 1, 2, 4, or 8.')
 
             # XXX: Handle sizes > 8 bytes
-            pack_fmt = (
-                # XXX: Endianness string bug
-                '<' if self._function.arch.endianness == Endianness.LittleEndian
-                else ''
-            ) + fmt[length]
-
-            data = struct.pack(pack_fmt, data)
+            if length == 1:
+                data = data.to_bytes(1, 'little')
+            else:
+                data = self._packers[length].pack(data)
 
         self._memory.write(addr, data)
 
         return True
 
+    def _switch_function(self, function):
+        decoded = self._instr_cache.get(id(function))
+
+        if decoded is None:
+            # Only Emilator's own handlers are used to fold constants
+            decoded = decode.DecodedFunction(
+                function, self._DISPATCH, self._eval, Emilator._DISPATCH
+            )
+            self._instr_cache[id(function)] = decoded
+
+        self._function = function
+        self._decoded = decoded
+
+        if function.arch.endianness == Endianness.LittleEndian:
+            self._packers = little_endian_packers
+        else:
+            self._packers = big_endian_packers
+
+        self._instructions = decoded.instructions
+        self._function_len = len(decoded.instructions)
+        self._blocks = decoded.blocks
+        self._block_hits = decoded.block_hits
+        self._compiled_blocks = decoded.compiled_blocks
+
+    def _codegen_block(self, start):
+        # Compiled code inlines Emilator's own visitors, falling back to
+        # the interpreter for anything a subclass overrides.
+        compiled = codegen.compile_block(
+            self, start, self._blocks[start], Emilator
+        )
+        self._compiled_blocks[start] = compiled
+        return compiled
+
     def execute_instruction(self):
+        index = self.instr_index
+
+        if index >= self._function_len:
+            # The function may have been appended to since it was decoded
+            self._decoded.update()
+            self._function_len = len(self._instructions)
+
+            if index >= self._function_len:
+                raise StopIteration
+
         # Execute the current IL instruction
-        instruction = self._function[self.instr_index]
+        instruction = self._instructions[index]
 
         # increment to next instruction (can be changed by instruction)
         self.instr_index += 1
 
-        self.visit(instruction)
+        instruction.handler(self, instruction)
+
+    def _execute_block(self):
+        # Like execute_instruction, but runs a whole basic block at once
+        # when it has been compiled, so only for callers that don't look
+        # at the state between instructions.
+        index = self.instr_index
+        compiled = self._compiled_blocks.get(index)
+
+        if compiled is None:
+            hits = self._block_hits.get(index)
+
+            if hits is not None:
+                hits += 1
+                self._block_hits[index] = hits
+
+                if hits == self.jit_threshold:
+                    compiled = self._codegen_block(index)
+
+        if compiled is not None and compiled():
+            return
+
+        self.execute_instruction()
+
+    def run(self, batch=1):
+        # Yield after every `batch` instructions rather than after each one
+        if batch < 1:
+            raise ValueError('batch must be at least 1')
+
+        return self._run(batch)
+
+    def _run(self, batch):
+        execute_instruction = self.execute_instruction
 
-    def run(self):
         while True:
             try:
-                yield self.execute_instruction()
-            except IndexError:
-                if self.instr_index >= len(self.function):
-                    raise StopIteration()
-                else:
-                    raise
+                for _ in range(batch):
+                    execute_instruction()
+            except StopIteration:
+                return
+
+            yield
+
+    def run_until_halt(self):
+        if self.jit_threshold:
+            execute = self._execute_block
+        else:
+            execute = self.execute_instruction
+
+        try:
+            while True:
+                execute()
+        except StopIteration:
+            return
 
     def _find_available_segment(self, size=0x1000, align=1):
-        new_segment = None
-        current_address = 0
         max_address = (1 << (self._function.arch.address_size * 8)) - 1
-        align_mask = (1 << (self._function.arch.address_size * 8)) - align
+        align_mask = ~(align - 1)
+
+        # Walk the gaps between segments in address order, rather than
+        # probing the view address by address.
+        current_address = 0
+
+        for segment in sorted(self._view.segments, key=lambda s: s.start):
+            current_address = (current_address + align - 1) & align_mask
 
-        while current_address < (max_address - size):
-            segment = self._view.get_segment_at(current_address)
+            if segment.start - current_address >= size:
+                return current_address
 
-            if segment is not None:
-                current_address = (segment.end + align) & align_mask
-                continue
+            current_address = max(current_address, segment.end)
 
-            segment_end = current_address + size - 1
+        current_address = (current_address + align - 1) & align_mask
 
-            if self._view.get_segment_at(segment_end) is None:
-                new_segment = current_address
-                break
+        if current_address + size - 1 <= max_address:
+            return current_address
 
-        return new_segment
+        return None
+
+    def _eval(self, expr):
+        # Constants and register reads make up most operands, so handle
+        # them here instead of going through the dispatch table.
+        operation = expr.operation
+
+        if operation is LLIL_CONST or operation is LLIL_CONST_PTR:
+            return expr.constant
+
+        if operation is LLIL_REG:
+            return self.get_register_value(expr.src)
+
+        return expr.handler(self, expr)
 
     def visit_LLIL_SET_REG(self, expr):
-        value = self.visit(expr.src)
+        value = self._eval(expr.src)
         self.set_register_value(expr.dest, value)
         return True
 
@@ -313,38 +556,45 @@ class Emilator(llilvisitor.LLILVisitor):
         return value
 
     def visit_LLIL_LOAD(self, expr):
-        addr = self.visit(expr.src)
-        return self.read_memory(addr, expr.size)
+        addr = self._eval(expr.src)
+        return self._read_fast(addr, expr.size)
 
     def visit_LLIL_STORE(self, expr):
-        addr = self.visit(expr.dest)
-        value = self.visit(expr.src)
+        addr = self._eval(expr.dest)
+        value = self._eval(expr.src)
         self.write_memory(addr, value, expr.size)
         return True
 
-    def visit_LLIL_PUSH(self, expr):
-        sp = self.function.arch.stack_pointer
+    def _read_sp(self):
+        sp_value = self._reg_values[self._sp_desc.reg_id]
 
-        value = self.visit(expr.src)
+        if sp_value is None:
+            raise errors.UndefinedError(
+                'Register {} not defined'.format(self._sp_name)
+            )
 
-        sp_value = self.get_register_value(sp)
+        return sp_value
 
-        self.write_memory(sp_value, value, expr.size)
+    def _write_sp(self, sp_value):
+        sp_value &= self._sp_desc.mask
+        self._reg_values[self._sp_desc.reg_id] = sp_value
+        return sp_value
 
-        sp_value -= expr.size
+    def visit_LLIL_PUSH(self, expr):
+        value = self._eval(expr.src)
 
-        return self.set_register_value(sp, sp_value)
+        sp_value = self._read_sp()
 
-    def visit_LLIL_POP(self, expr):
-        sp = self.function.arch.stack_pointer
+        self.write_memory(sp_value, value, expr.size)
 
-        sp_value = self.get_register_value(sp)
+        return self._write_sp(sp_value - expr.size)
 
-        sp_value += expr.size
+    def visit_LLIL_POP(self, expr):
+        sp_value = self._read_sp() + expr.size
 
-        value = self.read_memory(sp_value, expr.size)
+        value = self._read_fast(sp_value, expr.size)
 
-        self.set_register_value(sp, sp_value)
+        self._write_sp(sp_value)
 
         return value
 
@@ -353,7 +603,7 @@ class Emilator(llilvisitor.LLILVisitor):
         return self.instr_index
 
     def visit_LLIL_IF(self, expr):
-        condition = self.visit(expr.condition)
+        condition = self._eval(expr.condition)
 
         if condition:
             self.instr_index = expr.true
@@ -363,58 +613,52 @@ class Emilator(llilvisitor.LLILVisitor):
         return condition
 
     def visit_LLIL_CMP_NE(self, expr):
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
 
         return left != right
 
     def visit_LLIL_CMP_E(self, expr):
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
 
         return left == right
 
     def visit_LLIL_CMP_SLT(self, expr):
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
-
-        if (left & (1 << ((expr.size * 8) - 1))):
-            left = left - (1 << (expr.size * 8))
-
-        if (right & (1 << ((expr.size * 8) - 1))):
-            right = right - (1 << (expr.size * 8))
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
+        sign_bit = sign_bits[expr.size]
 
-        return left < right
+        return ((left ^ sign_bit) - sign_bit) < ((right ^ sign_bit) - sign_bit)
 
     def visit_LLIL_CMP_UGT(self, expr):
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
         return left > right
 
     def visit_LLIL_ADD(self, expr):
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
-        mask = (1 << expr.size * 8) - 1
-        return (left + right) & mask
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
+        return (left + right) & size_masks[expr.size]
 
     def visit_LLIL_AND(self, expr):
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
         return left & right
 
     def visit_LLIL_OR(self, expr):
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
         return left | right
 
     def visit_LLIL_SUB(self, expr):
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
         return left - right
 
     def visit_LLIL_SET_FLAG(self, expr):
         flag = expr.dest.index
-        value = self.visit(expr.src)
+        value = self._eval(expr.src)
         return self.set_flag_value(flag, value)
 
     def visit_LLIL_FLAG(self, expr):
@@ -427,47 +671,51 @@ class Emilator(llilvisitor.LLILVisitor):
         raise StopIteration
 
     def visit_LLIL_CALL(self, expr):
-        target = self.visit(expr.dest)
+        target = self._eval(expr.dest)
 
         if target in self._function_hooks:
             self._function_hooks[target](self)
             return True
 
-        target_function = self._view.get_function_at(target)
+        target_llil = self._call_target_cache.get(target)
 
-        if not target_function:
-            self._view.create_user_function(target)
-            self._view.update_analysis_and_wait()
+        if target_llil is None:
             target_function = self._view.get_function_at(target)
 
-        self._function = target_function.low_level_il
+            if not target_function:
+                self._view.create_user_function(target)
+                self._view.update_analysis_and_wait()
+                target_function = self._view.get_function_at(target)
+
+            target_llil = target_function.low_level_il
+            self._call_target_cache[target] = target_llil
+
+        self._switch_function(target_llil)
         self.instr_index = 0
 
         return True
 
     def visit_LLIL_SX(self, expr):
-        orig_value = self.visit(expr.src)
-        sign_bit = 1 << ((expr.size * 8) - 1)
-        extend_value = (orig_value & (sign_bit - 1)) - (orig_value & sign_bit)
-        return extend_value
+        orig_value = self._eval(expr.src)
+        extend_value = sign_extend(orig_value, expr.src.size * 8)
+        return extend_value & size_masks[expr.size]
 
     def visit_LLIL_ZX(self, expr):
-        return self.visit(expr.src)
+        return self._eval(expr.src)
 
     def visit_LLIL_XOR(self, expr):
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
         return left ^ right
 
     def visit_LLIL_LSL(self, expr):
-        mask = (1 << expr.size * 8) - 1
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
-        return (left << right) & mask
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
+        return (left << right) & size_masks[expr.size]
 
     def visit_LLIL_LSR(self, expr):
-        left = self.visit(expr.left)
-        right = self.visit(expr.right)
+        left = self._eval(expr.left)
+        right = self._eval(expr.right)
         return left >> right
 
 
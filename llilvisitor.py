@@ -1,8 +1,62 @@
+from binaryninja import LowLevelILOperation
+
 from .bnilvisitor import BNILVisitor
 from . import errors
 
 
-class LLILVisitor(BNILVisitor):
+class DispatchTable(dict):
+    def __missing__(self, operation):
+        raise errors.UnimplementedError(operation)
+
+    def resolve(self, operation, size):
+        # Prefer a handler specialized for the operand size. With no
+        # handler at all, return one that raises when it is reached.
+        handler = self.get((operation, size)) or self.get(operation)
+
+        if handler is None:
+            def handler(visitor, expression):
+                raise errors.UnimplementedError(operation)
+
+        return handler
+
+
+class DispatchMeta(type):
+    # Builds the operation -> visit_LLIL_* function table once per class,
+    # rather than once per instance, along with the (operation, size)
+    # entries from the class's _SIZE_SPECIALIZATIONS. Entries are plain
+    # functions, called with the visitor as their first argument.
+    def __init__(cls, name, bases, namespace):
+        super(DispatchMeta, cls).__init__(name, bases, namespace)
+
+        dispatch = DispatchTable()
+
+        for base in reversed(bases):
+            dispatch.update(getattr(base, '_DISPATCH', {}))
+
+        for attr, value in namespace.items():
+            if not attr.startswith('visit_LLIL_'):
+                continue
+
+            operation = getattr(LowLevelILOperation, attr[len('visit_'):])
+
+            # An override replaces any size specialized inherited handlers
+            for key in [k for k in dispatch if isinstance(k, tuple)]:
+                if key[0] == operation:
+                    del dispatch[key]
+
+            dispatch[operation] = value
+
+        # operation -> (factory returning the handler for a size, sizes)
+        specializations = namespace.get('_SIZE_SPECIALIZATIONS', {})
+
+        for operation, (specialize, sizes) in specializations.items():
+            for size in sizes:
+                dispatch[(operation, size)] = specialize(size)
+
+        cls._DISPATCH = dispatch
+
+
+class LLILVisitor(BNILVisitor, metaclass=DispatchMeta):
     def __init__(self, **kwargs):
         super(LLILVisitor, self).__init__(**kwargs)
         self._hooks = {}
@@ -7,10 +7,14 @@ from . import errors
 
 #MemoryRange = namedtuple('MemoryRange', ['start', 'length', 'flags', 'data'])
 
+# Number of most recently used ranges Memory checks before searching
+RECENT_RANGES = 3
+
 class MemoryRange(object):
     def __init__(self, start, length, flags=0, data=None):
         self.start = start
         self.length = length
+        self.end = start + length
         self.flags = flags
 
         if data is None:
@@ -42,10 +46,7 @@ class MemoryRange(object):
         if isinstance(other, int):
             return cmp(self.start, other)
 
-        start_cmp = cmp(self.start, other.start)
-        if start_cmp == 0:
-            return cmp(self.length, other.length)
-        return start_cmp
+        return cmp((self.start, self.length), (other.start, other.length))
 
     def __repr__(self):
         return '<MemoryRange: start={:x}, length={:x}, flags={}>'.format(
@@ -59,82 +60,68 @@ class Memory(object):
         self._address_size = address_size
 
         self._ranges = []
+        self._recent = []
 
     def __contains__(self, address):
-        range_index = bisect.bisect_left(self._ranges, address)
+        return self._range_at(address) is not None
+
+    def __iter__(self):
+        return iter(self._ranges)
 
-        if range_index > len(self._ranges):
-            return False
+    def _range_at(self, address):
+        # Accesses cluster in a few ranges (code, stack, heap), so check
+        # the most recently used ones before searching.
+        for range in self._recent:
+            if range.start <= address < range.end:
+                return range
 
-        try:
-            if self._ranges[range_index].start == address:
-                return True
-        except IndexError:
-            pass
+        idx = bisect.bisect_right(self._ranges, address) - 1
 
-        if range_index == 0:
-            return False
+        if idx < 0:
+            return None
 
-        try:
-            prev_range = self._ranges[range_index - 1]
-        except IndexError:
-            return False
+        range = self._ranges[idx]
 
-        if (prev_range.start < address and
-                prev_range.length + prev_range.start > address):
-            return True
+        if address >= range.end:
+            return None
 
-        return False
+        self._recent = [range] + self._recent[:RECENT_RANGES - 1]
 
-    def __iter__(self):
-        return iter(self._ranges)
+        return range
 
-    def read(self, address, length):
+    def _checked_range(self, address, length):
         # XXX: Handle split ranges
-        idx = bisect.bisect_left(self._ranges, address)
-
-        try:
-            if self._ranges[idx].start > address:
-                idx -= 1
-        except IndexError:
-            idx -= 1
-
-        try:
-            range = self._ranges[idx]
-        except IndexError:
-            raise errors.MemoryAccessError(address=address)
-
-        if range.start <= address < range.length:
-            if range.start + length > range.length:
-                raise errors.MemoryAccessError(
-                    '{[{:x},{:x}] is not valid range of memory'.format(
-                        address, address+length
-                    ),
-                    address=address
-                )
-        return range.data[address-range.start:address+length-range.start].tobytes()
+        range = self._range_at(address)
+
+        if range is None or address + length > range.end:
+            raise errors.MemoryAccessError(
+                '[{:x},{:x}] is not valid range of memory'.format(
+                    address, address+length
+                ),
+                address=address
+            )
 
-    def write(self, address, value):
-        length = len(value)
+        return range
 
-        # XXX: Handle split ranges
-        idx = bisect.bisect_left(self._ranges, address)
-        
-        if idx == len(self._ranges) or self._ranges[idx].start > address:
-            idx -= 1
+    def lookup(self, address, length):
+        # Returns the backing memoryview of the range holding
+        # [address, address+length) and the offset of address in it
+        range = self._checked_range(address, length)
+        return range.data, address - range.start
 
-        range = self._ranges[idx]
+    def read_bytes(self, address, length):
+        # Returns a memoryview into the range, without copying
+        data, offset = self.lookup(address, length)
+        return data[offset:offset+length]
 
-        if range.start <= address < range.length:
-            if range.start + length > range.length:
-                raise errors.MemoryAccessError(
-                    '{[{:x},{:x}] is not valid range of memory'.format(
-                        address, address+length
-                    ),
-                    address=address
-                )
+    def read(self, address, length):
+        return self.read_bytes(address, length).tobytes()
 
-        range.data[address-range.start:address+length-range.start] = value
+    def write(self, address, value):
+        length = len(value)
+        range = self._checked_range(address, length)
+        offset = address - range.start
+        range.data[offset:offset+length] = value
 
     def map(self,
             start=None,
@@ -145,6 +132,7 @@ class Memory(object):
             start = self._find_available_base(length)
 
         bisect.insort(self._ranges, MemoryRange(start, length, flags, data))
+        self._recent = []
 
         return start
 